@@ -1,12 +1,16 @@
 # %%
-import requests
+import asyncio
 import datetime
-import time
-import dotenv
+import json
 import os
-import shutil
-import threading
+import sys
+import time
 from pathlib import Path
+
+import aiofiles
+import aiohttp
+import dotenv
+import orjson
 from tqdm import tqdm
 
 # %%
@@ -17,6 +21,9 @@ CHANNEL: str = str(denv.get("CHANNEL", "hardstyle"))
 DI_USERNAME: str = str(denv.get("DI_USERNAME", ""))
 DI_PASSWORD: str = str(denv.get("DI_PASSWORD", ""))
 
+WRITE_BUF_SIZE = 256 * 1024  # coalesce downloaded chunks into writes this big
+PBAR_UPDATE_BYTES = 1024 * 1024  # batch progress-bar updates per MiB
+
 
 def load_channels() -> list[str]:
     """Load channels from favorites.txt, falling back to CHANNEL env var."""
@@ -28,19 +35,19 @@ def load_channels() -> list[str]:
     return [CHANNEL]
 
 
-def login() -> str:
+async def login(session: aiohttp.ClientSession) -> str:
     """Login to DI.FM and return API key."""
     if not DI_USERNAME or not DI_PASSWORD:
         raise Exception("DI_USERNAME and DI_PASSWORD required in .env")
 
-    response = requests.post(
+    async with session.post(
         "https://api.audioaddict.com/v1/di/members/authenticate",
         data={"username": DI_USERNAME, "password": DI_PASSWORD},
-    )
-    if response.status_code != 200:
-        raise Exception(f"Login failed: {response.status_code} {response.text}")
+    ) as response:
+        if response.status != 200:
+            raise Exception(f"Login failed: {response.status} {await response.text()}")
+        data = await response.json(loads=orjson.loads)
 
-    data = response.json()
     api_key = data.get("api_key")
     if not api_key:
         raise Exception(f"No api_key in response: {data}")
@@ -48,116 +55,216 @@ def login() -> str:
     return api_key
 
 
-def get_channel_id(channel_key: str) -> int:
-    """Get channel ID from channel key."""
+async def get_channel_map(session: aiohttp.ClientSession) -> dict[str, int]:
+    """Fetch the channel list once and return a key -> id map."""
     url = "https://api.audioaddict.com/v1/di/channels"
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise Exception(f"Failed to get channels: {response.status_code}")
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise Exception(f"Failed to get channels: {response.status}")
+        channels = await response.json(loads=orjson.loads)
 
-    for ch in response.json():
-        if ch["key"] == channel_key:
-            return ch["id"]
-    raise Exception(f"Channel not found: {channel_key}")
+    return {ch["key"]: ch["id"] for ch in channels}
 
 
-def get_routine(channel_id: int, api_key: str):
+async def get_routine(session: aiohttp.ClientSession, channel_id: int, api_key: str):
     """Get current routine (playlist) for a channel."""
     url = f"https://api.audioaddict.com/v1/di/routines/channel/{channel_id}?tune_in=true"
-    response = requests.get(url, headers={"X-Api-Key": api_key})
-    if response.status_code != 200:
-        raise Exception(f"Failed to get routine: {response.status_code}")
-    return response.json()
-
-
-def get_currently_playing(channel_id: int):
-    """Get currently playing track info."""
-    url = "https://api.audioaddict.com/v1/di/currently_playing"
-    response = requests.get(url)
-    if response.status_code != 200:
-        return None
-
-    for cp in response.json():
+    async with session.get(url, headers={"X-Api-Key": api_key}) as response:
+        if response.status != 200:
+            raise Exception(f"Failed to get routine: {response.status}")
+        return await response.json(loads=orjson.loads)
+
+
+# /currently_playing returns every channel in one payload, so N channel
+# tasks share a single fetch per interval instead of issuing N identical ones.
+CURRENTLY_PLAYING_TTL = 5.0
+_currently_playing_cache: list = []
+_currently_playing_at: float = 0.0
+_currently_playing_lock = asyncio.Lock()
+
+
+async def get_currently_playing(session: aiohttp.ClientSession, channel_id: int):
+    """Get currently playing track info, batching the fetch across channels."""
+    global _currently_playing_cache, _currently_playing_at
+
+    async with _currently_playing_lock:
+        now = time.monotonic()
+        if now - _currently_playing_at >= CURRENTLY_PLAYING_TTL:
+            url = "https://api.audioaddict.com/v1/di/currently_playing"
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return None
+                _currently_playing_cache = await response.json(loads=orjson.loads)
+            _currently_playing_at = now
+
+    for cp in _currently_playing_cache:
         if cp["channel_id"] == channel_id:
             return cp
     return None
 
 
-def download_track(url: str, output_path: str, desc: str = "Downloading"):
+async def get_content_length(session: aiohttp.ClientSession, url: str) -> int:
+    """HEAD the asset and return its Content-Length, or 0 if unknown."""
+    if url.startswith("//"):
+        url = "https:" + url
+
+    async with session.head(url, allow_redirects=True) as response:
+        if response.status != 200:
+            return 0
+        return int(response.headers.get("Content-Length", 0))
+
+
+class _LineProgress:
+    """Minimal tqdm stand-in for headless runs: one plain line per track."""
+
+    def __init__(self, total: int, desc: str):
+        self.total = total
+        self.desc = desc
+        self.n = 0
+
+    def update(self, n: int):
+        self.n += n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        print(f"{self.desc}: {self.n / 1e6:.1f} MB")
+
+
+def make_progress(total: int, desc: str):
+    """tqdm on a TTY; when output is redirected (systemd, nohup, cron) use a
+    plain printer so logs don't fill with ANSI carriage-return rewrites."""
+    if sys.stderr.isatty():
+        return tqdm(total=total, unit='B', unit_scale=True, desc=desc)
+    return _LineProgress(total, desc)
+
+
+# Cap simultaneous track downloads so a burst of track changes across many
+# channels doesn't saturate the link and starve the polling requests.
+DOWNLOAD_CONCURRENCY = 4
+_download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+
+async def download_track(session: aiohttp.ClientSession, url: str, output_path: str, desc: str = "Downloading"):
     """Download a track with progress bar."""
     # Ensure URL has https
     if url.startswith("//"):
         url = "https:" + url
 
-    response = requests.get(url, stream=True)
-    if response.status_code != 200:
-        print(f"Failed to download: {response.status_code}")
-        return False
+    # MP3s are already compressed — identity encoding keeps the response
+    # stream out of the decompressor entirely.
+    async with _download_semaphore, session.get(url, headers={"Accept-Encoding": "identity"}) as response:
+        if response.status != 200:
+            print(f"Failed to download: {response.status}")
+            return False
+
+        total_size = int(response.headers.get('Content-Length', 0))
+
+        # Coalesce network chunks into 256 KiB writes so a full track costs
+        # dozens of write syscalls instead of thousands, and batch progress
+        # updates per MiB so tqdm isn't called ~1000 times per track.
+        write_buf = bytearray()
+        pbar_pending = 0
+        async with aiofiles.open(output_path, 'wb') as f:
+            if total_size:
+                # Reserve the full extent up front so the filesystem lays the
+                # track out contiguously instead of growing it write by write.
+                try:
+                    await asyncio.to_thread(os.posix_fallocate, f.fileno(), 0, total_size)
+                except OSError:
+                    pass  # not supported on this filesystem
+            with make_progress(total_size, desc) as pbar:
+                async for chunk in response.content.iter_chunked(WRITE_BUF_SIZE):
+                    write_buf += chunk
+                    if len(write_buf) >= WRITE_BUF_SIZE:
+                        await f.write(write_buf)
+                        write_buf.clear()
+                    pbar_pending += len(chunk)
+                    if pbar_pending >= PBAR_UPDATE_BYTES:
+                        pbar.update(pbar_pending)
+                        pbar_pending = 0
+                if write_buf:
+                    await f.write(write_buf)
+                if pbar_pending:
+                    pbar.update(pbar_pending)
 
-    total_size = int(response.headers.get('content-length', 0))
+    return True
 
-    with open(output_path, 'wb') as f:
-        with tqdm(total=total_size, unit='B', unit_scale=True, desc=desc) as pbar:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-                pbar.update(len(chunk))
 
-    return True
+def load_downloaded_ids(channel_dir: str) -> set[int]:
+    """Load the persisted set of track ids already handled for a channel."""
+    path = os.path.join(channel_dir, ".downloaded_ids.json")
+    try:
+        with open(path) as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+
+def save_downloaded_ids(channel_dir: str, downloaded_ids: set[int]):
+    """Persist the handled track ids so restarts don't re-download."""
+    path = os.path.join(channel_dir, ".downloaded_ids.json")
+    with open(path, "w") as f:
+        json.dump(sorted(downloaded_ids), f)
+
+
+_SANITIZE_TABLE = str.maketrans("", "", r'<>:"/\|?*')
 
 
 def sanitize_filename(name: str) -> str:
     """Remove invalid filename characters."""
-    return "".join(c for c in name if c not in r'<>:"/\|?*')
+    return name.translate(_SANITIZE_TABLE)
 
 
-def scrape_channel(channel_key: str, api_key: str):
+async def scrape_channel(session: aiohttp.ClientSession, channel_key: str, channel_id: int, api_key: str):
     """Scrape a single channel continuously."""
     channel_dir = os.path.join(MP3_DIR, channel_key)
     os.makedirs(channel_dir, exist_ok=True)
 
     tag = f"[{channel_key}]"
-    print(f"{tag} Getting channel ID...")
-    channel_id = get_channel_id(channel_key)
     print(f"{tag} Channel ID: {channel_id}")
 
-    downloaded_ids = set()
+    downloaded_ids = load_downloaded_ids(channel_dir)
+    if downloaded_ids:
+        print(f"{tag} Resuming with {len(downloaded_ids)} known track ids")
+
+    def remember(track_id):
+        downloaded_ids.add(track_id)
+        save_downloaded_ids(channel_dir, downloaded_ids)
 
     while True:
         try:
-            routine = get_routine(channel_id, api_key)
+            routine = await get_routine(session, channel_id, api_key)
 
-            currently_playing = get_currently_playing(channel_id)
+            currently_playing = await get_currently_playing(session, channel_id)
             if not currently_playing:
-                time.sleep(10)
+                await asyncio.sleep(10)
                 continue
 
             current_track_id = currently_playing["track"]["id"]
 
-            current_track = None
-            for track in routine.get("tracks", []):
-                if track["id"] == current_track_id:
-                    current_track = track
-                    break
+            tracks_by_id = {track["id"]: track for track in routine.get("tracks", [])}
+            current_track = tracks_by_id.get(current_track_id)
 
             if not current_track:
-                time.sleep(10)
+                await asyncio.sleep(10)
                 continue
 
             # Skip if already downloaded — just wait silently
             if current_track_id in downloaded_ids:
                 start_time_str = currently_playing["track"]["start_time"]
                 duration = currently_playing["track"]["duration"]
-                start_time = datetime.datetime.fromisoformat(start_time_str)
-                elapsed = (datetime.datetime.now(datetime.timezone.utc) - start_time).total_seconds()
-                time_left = max(0, duration - elapsed)
-                time.sleep(min(time_left + 2, 30))
+                start_ts = datetime.datetime.fromisoformat(start_time_str).timestamp()
+                time_left = max(0, duration - (time.time() - start_ts))
+                await asyncio.sleep(min(time_left + 2, 30))
                 continue
 
             content = current_track.get("content", {})
             assets = content.get("assets", [])
             if not assets:
-                downloaded_ids.add(current_track_id)
-                time.sleep(5)
+                remember(current_track_id)
+                await asyncio.sleep(5)
                 continue
 
             track_url = assets[0]["url"]
@@ -166,62 +273,77 @@ def scrape_channel(channel_key: str, api_key: str):
             output_path = f"{channel_dir}/{safe_name}.mp3"
 
             if os.path.exists(output_path):
-                downloaded_ids.add(current_track_id)
-                continue
+                # Cheap HEAD to catch files truncated by an earlier crash;
+                # only ever issued once per track thanks to downloaded_ids.
+                expected_size = await get_content_length(session, track_url)
+                if not expected_size or os.path.getsize(output_path) == expected_size:
+                    remember(current_track_id)
+                    continue
+                print(f"{tag} Incomplete file ({os.path.getsize(output_path)}/{expected_size} bytes), re-downloading: {safe_name}")
 
             start_time_str = currently_playing["track"]["start_time"]
             duration = currently_playing["track"]["duration"]
-            start_time = datetime.datetime.fromisoformat(start_time_str)
-            end_time = start_time + datetime.timedelta(seconds=duration)
+            end_ts = datetime.datetime.fromisoformat(start_time_str).timestamp() + duration
 
             print(f"\n{tag} Downloading: {track_name}")
 
-            temp_path = f"{channel_dir}/temp.mp3"
-            if download_track(track_url, temp_path, desc=f"{channel_key}: {safe_name[:40]}"):
-                shutil.move(temp_path, output_path)
+            # Same directory as the final path, so publishing is one rename(2)
+            # and never a cross-filesystem copy.
+            temp_path = f"{channel_dir}/.{safe_name}.mp3.part"
+            if await download_track(session, track_url, temp_path, desc=f"{channel_key}: {safe_name[:40]}"):
+                os.replace(temp_path, output_path)
                 print(f"{tag} Saved: {safe_name}.mp3")
-                downloaded_ids.add(current_track_id)
+                remember(current_track_id)
             else:
                 print(f"{tag} Failed: {track_name}")
                 if os.path.exists(temp_path):
                     os.remove(temp_path)
 
-            now = datetime.datetime.now(datetime.timezone.utc)
-            time_left = (end_time - now).total_seconds()
+            time_left = end_ts - time.time()
             if time_left > 0:
                 print(f"{tag} Waiting {time_left:.0f}s for track to end...")
-                time.sleep(time_left + 1)
+                await asyncio.sleep(time_left + 1)
 
-        except KeyboardInterrupt:
-            break
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             print(f"{tag} Error: {e}")
-            time.sleep(10)
+            await asyncio.sleep(10)
 
 
-def main():
+async def run():
     channels = load_channels()
 
-    print("Logging in to DI.FM...")
-    api_key = login()
-    print(f"Got API key: {api_key[:8]}...")
-    print(f"Scraping {len(channels)} channels: {', '.join(channels)}")
+    # One session shared by every channel: a few pooled keep-alive sockets
+    # instead of a new TCP+TLS handshake per request.
+    connector = aiohttp.TCPConnector(limit=32, limit_per_host=8, keepalive_timeout=75)
+    # No total= cap: a full track download may legitimately take minutes.
+    timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        print("Logging in to DI.FM...")
+        api_key = await login(session)
+        print(f"Got API key: {api_key[:8]}...")
+        print(f"Scraping {len(channels)} channels: {', '.join(channels)}")
+
+        # One /channels fetch shared by every task instead of one per channel.
+        channel_map = await get_channel_map(session)
+        for ch in channels:
+            if ch not in channel_map:
+                raise Exception(f"Channel not found: {ch}")
 
-    if len(channels) == 1:
-        scrape_channel(channels[0], api_key)
-    else:
-        threads = []
+        tasks = []
         for ch in channels:
-            t = threading.Thread(target=scrape_channel, args=(ch, api_key), daemon=True)
-            t.start()
-            threads.append(t)
-            time.sleep(0.5)  # Stagger API calls
+            tasks.append(asyncio.create_task(scrape_channel(session, ch, channel_map[ch], api_key)))
+            await asyncio.sleep(0.5)  # Stagger API calls
 
-        try:
-            while any(t.is_alive() for t in threads):
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print("\nStopping...")
+        await asyncio.gather(*tasks)
+
+
+def main():
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("\nStopping...")
 
 
 if __name__ == "__main__":
@@ -1,13 +1,21 @@
-import json
+import ctypes
+import gzip
+import io
 import os
 import random
+import socket
 import sqlite3
+import sys
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 import dotenv
-from mutagen.id3 import ID3
+import orjson
+from mutagen.id3 import ID3, TIT2, TPE1, TXXX
 
 denv = dotenv.dotenv_values(".env")
 MP3_DIR = Path(denv.get("MP3_DIR", "/mnt/raid5/mp3s"))
@@ -15,9 +23,42 @@ HOST = denv.get("SERVE_HOST", "0.0.0.0")
 PORT = int(denv.get("SERVE_PORT", "8000"))
 DB_PATH = MP3_DIR / "library.db"
 
+# Resolved once at import; every request-path safety check compares against
+# this string instead of re-resolving the library root.
+MP3_ROOT = str(MP3_DIR.resolve())
+
+
+def safe_full_path(rel_path: str) -> Path | None:
+    """Resolve a client-supplied library path, rejecting escapes from MP3_DIR."""
+    full_path = os.path.realpath(os.path.join(MP3_ROOT, rel_path))
+    if not full_path.startswith(MP3_ROOT + os.sep):
+        return None
+    return Path(full_path)
+
 # Global library cache: {channel: [track, ...]}
 library: dict[str, list[dict]] = {}
 
+# The only frames we ever read. Passing this to ID3() keeps mutagen from
+# decoding everything else in the tag (album art, lyrics, ...) — unknown
+# frames are carried as raw bytes instead of parsed.
+_KNOWN_FRAMES = {"TPE1": TPE1, "TIT2": TIT2, "TXXX": TXXX}
+
+# One read this big almost always swallows the whole ID3v2 tag, so parsing
+# happens from memory instead of mutagen seeking around the file.
+_TAG_READ_SIZE = 128 * 1024
+
+
+def read_tags(path) -> ID3:
+    """Parse just the artist/title/rating frames from an MP3's ID3 tag."""
+    with open(path, "rb") as f:
+        head = f.read(_TAG_READ_SIZE)
+    if head[:3] == b"ID3" and len(head) >= 10:
+        # Syncsafe 28-bit tag size from the v2 header
+        tag_size = (head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | head[9] & 0x7F
+        if tag_size + 10 <= len(head):
+            return ID3(fileobj=io.BytesIO(head), known_frames=_KNOWN_FRAMES)
+    return ID3(path, known_frames=_KNOWN_FRAMES)
+
 
 def load_favorites() -> list[str]:
     fav_path = Path(__file__).parent / "favorites.txt"
@@ -34,8 +75,13 @@ def init_db():
         title TEXT,
         category TEXT,
         rating INTEGER DEFAULT 0,
-        mtime REAL
+        mtime REAL,
+        size INTEGER DEFAULT 0
     )""")
+    # Migrate DBs created before the size column existed
+    cols = {row[1] for row in db.execute("PRAGMA table_info(tracks)")}
+    if "size" not in cols:
+        db.execute("ALTER TABLE tracks ADD COLUMN size INTEGER DEFAULT 0")
     db.execute("CREATE INDEX IF NOT EXISTS idx_category ON tracks(category)")
     db.commit()
     return db
@@ -57,7 +103,7 @@ def import_id3_ratings(db: sqlite3.Connection):
         if not full_path.exists():
             continue
         try:
-            tags = ID3(full_path)
+            tags = read_tags(full_path)
             txxx = tags.getall("TXXX:RATING")
             if txxx and txxx[0].text:
                 rating = int(txxx[0].text[0])
@@ -72,6 +118,56 @@ def import_id3_ratings(db: sqlite3.Connection):
         print(f"Imported {imported} ratings from ID3 tags")
 
 
+# Channel-dir mtimes from the previous scan in this process. A directory
+# whose mtime hasn't changed can't have gained, lost, or renamed files
+# (the scraper publishes via rename), so its DB rows are still current.
+_scan_dir_mtimes: dict[str, float] = {}
+
+
+def _scan_channel(channel: str, cached_stats: dict[str, tuple[float, int]]) -> tuple[set[str], list[tuple]]:
+    """Scan one channel dir; return (paths present, rows needing upsert).
+
+    Runs in a worker thread — tag reads are I/O-bound, so channels scan in
+    parallel. DB writes stay on the calling thread.
+    """
+    channel_dir = MP3_DIR / channel
+    present: set[str] = set()
+    rows: list[tuple] = []
+
+    # scandir hands back names and cached stat results in one pass; no sort
+    # needed here since track ordering comes from the DB query's ORDER BY.
+    with os.scandir(channel_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".mp3") or entry.name == "temp.mp3":
+                continue
+            rel_path = f"{channel}/{entry.name}"
+            present.add(rel_path)
+            st = entry.stat()
+            mtime, size = st.st_mtime, st.st_size
+
+            if cached_stats.get(rel_path) == (mtime, size):
+                continue
+
+            # New or modified file — read ID3 tags
+            stem = entry.name[:-4]
+            artist = ""
+            title = stem
+            try:
+                tags = read_tags(entry.path)
+                if "TPE1" in tags:
+                    artist = str(tags["TPE1"])
+                if "TIT2" in tags:
+                    title = str(tags["TIT2"])
+            except Exception:
+                parts = stem.split(" - ", 1)
+                if len(parts) == 2:
+                    artist, title = parts
+
+            rows.append((rel_path, artist, title, channel, mtime, size))
+
+    return present, rows
+
+
 def scan_library() -> dict[str, list[dict]]:
     favorites = load_favorites()
     result: dict[str, list[dict]] = {}
@@ -81,9 +177,9 @@ def scan_library() -> dict[str, list[dict]]:
 
     db = init_db()
 
-    # Load existing mtime cache from DB
-    cursor = db.execute("SELECT path, mtime FROM tracks")
-    cached_mtimes = {row[0]: row[1] for row in cursor.fetchall()}
+    # Load the existing (mtime, size) cache from DB
+    cursor = db.execute("SELECT path, mtime, size FROM tracks")
+    cached_stats = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
 
     # Discover all channel directories
     channels = []
@@ -96,44 +192,36 @@ def scan_library() -> dict[str, list[dict]]:
 
     # Scan filesystem and upsert new/modified files
     all_current_paths = set()
+    to_scan = []
     for channel in ordered:
         channel_dir = MP3_DIR / channel
-        for mp3_file in sorted(channel_dir.glob("*.mp3")):
-            if mp3_file.name == "temp.mp3":
-                continue
-            rel_path = f"{channel}/{mp3_file.name}"
-            all_current_paths.add(rel_path)
-            mtime = mp3_file.stat().st_mtime
-
-            if rel_path in cached_mtimes and cached_mtimes[rel_path] == mtime:
-                continue
-
-            # New or modified file — read ID3 tags
-            artist = ""
-            title = mp3_file.stem
-            try:
-                tags = ID3(mp3_file)
-                if "TPE1" in tags:
-                    artist = str(tags["TPE1"])
-                if "TIT2" in tags:
-                    title = str(tags["TIT2"])
-            except Exception:
-                parts = mp3_file.stem.split(" - ", 1)
-                if len(parts) == 2:
-                    artist, title = parts
-
-            db.execute(
-                """INSERT INTO tracks (path, artist, title, category, mtime)
-                   VALUES (?, ?, ?, ?, ?)
-                   ON CONFLICT(path) DO UPDATE SET
-                       artist=excluded.artist, title=excluded.title,
-                       category=excluded.category, mtime=excluded.mtime""",
-                (rel_path, artist, title, channel, mtime),
-            )
+        dir_mtime = channel_dir.stat().st_mtime
+        if _scan_dir_mtimes.get(channel) == dir_mtime:
+            # Unchanged since our last scan — keep its cached rows as-is.
+            prefix = channel + "/"
+            all_current_paths.update(p for p in cached_stats if p.startswith(prefix))
+            continue
+        _scan_dir_mtimes[channel] = dir_mtime
+        to_scan.append(channel)
+
+    if to_scan:
+        with ThreadPoolExecutor(max_workers=min(8, len(to_scan))) as pool:
+            results = pool.map(lambda ch: _scan_channel(ch, cached_stats), to_scan)
+            for present, rows in results:
+                all_current_paths |= present
+                db.executemany(
+                    """INSERT INTO tracks (path, artist, title, category, mtime, size)
+                       VALUES (?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(path) DO UPDATE SET
+                           artist=excluded.artist, title=excluded.title,
+                           category=excluded.category, mtime=excluded.mtime,
+                           size=excluded.size""",
+                    rows,
+                )
 
     # Remove deleted files from DB
-    if cached_mtimes:
-        deleted = set(cached_mtimes.keys()) - all_current_paths
+    if cached_stats:
+        deleted = set(cached_stats.keys()) - all_current_paths
         if deleted:
             db.executemany("DELETE FROM tracks WHERE path = ?", [(p,) for p in deleted])
 
@@ -145,11 +233,12 @@ def scan_library() -> dict[str, list[dict]]:
     # Build library from DB
     for channel in ordered:
         cursor = db.execute(
-            "SELECT artist, title, rating, path, category FROM tracks WHERE category = ? ORDER BY artist, title",
+            "SELECT artist, title, rating, path, category, size FROM tracks WHERE category = ? ORDER BY artist, title",
             (channel,),
         )
         tracks = [
-            {"artist": row[0], "title": row[1], "rating": row[2], "path": row[3], "category": row[4]}
+            {"artist": row[0], "title": row[1], "rating": row[2], "path": row[3],
+             "category": sys.intern(row[4]), "size": row[5]}
             for row in cursor.fetchall()
         ]
         if tracks:
@@ -167,12 +256,14 @@ def load_library_from_db() -> dict[str, list[dict]]:
         return result
 
     db = init_db()
-    cursor = db.execute("SELECT artist, title, rating, path, category FROM tracks ORDER BY category, artist, title")
+    cursor = db.execute("SELECT artist, title, rating, path, category, size FROM tracks ORDER BY category, artist, title")
 
     by_channel: dict[str, list[dict]] = {}
     for row in cursor.fetchall():
-        track = {"artist": row[0], "title": row[1], "rating": row[2], "path": row[3], "category": row[4]}
-        by_channel.setdefault(row[4], []).append(track)
+        category = sys.intern(row[4])
+        track = {"artist": row[0], "title": row[1], "rating": row[2], "path": row[3],
+                 "category": category, "size": row[5]}
+        by_channel.setdefault(category, []).append(track)
 
     channels = sorted(by_channel.keys())
     ordered = [c for c in favorites if c in by_channel]
@@ -185,48 +276,212 @@ def load_library_from_db() -> dict[str, list[dict]]:
     return result
 
 
+# path -> track dict, rebuilt with the library, so rating updates don't
+# linear-scan every channel.
+_track_index: dict[str, dict] = {}
+
+
+def _rebuild_track_index():
+    _track_index.clear()
+    for tracks in library.values():
+        for t in tracks:
+            _track_index[t["path"]] = t
+
+
 def refresh_library_cache(force_scan: bool = False) -> str:
     """Refresh in-memory library; returns 'db' or 'scan' based on source."""
     global library
 
     if force_scan:
         library = scan_library()
-        return "scan"
-
-    library = load_library_from_db()
-    if library:
-        return "db"
+        source = "scan"
+    else:
+        library = load_library_from_db()
+        source = "db"
+        if not library:
+            library = scan_library()
+            source = "scan"
 
-    library = scan_library()
-    return "scan"
+    _rebuild_track_index()
+    invalidate_stream_pool()
+    return source
 
 
 def set_rating(rel_path: str, rating: int):
     db = sqlite3.connect(DB_PATH)
     db.execute("UPDATE tracks SET rating = ? WHERE path = ?", (rating, rel_path))
+
+    # Mirror the rating into the file's TXXX:RATING so it survives losing
+    # the DB. This must be a full ID3 parse, not read_tags: the restricted
+    # frame map keeps unknown frames as raw bytes, and when a v2.3 tag is
+    # upgraded to v2.4 in memory those raw frames can't be re-emitted on
+    # save — one rating click would strip album art and comments. The
+    # restricted reader is only safe on paths that never write.
+    full_path = MP3_DIR / rel_path
+    try:
+        tags = ID3(full_path)
+        tags.delall("TXXX:RATING")
+        if rating > 0:
+            tags.add(TXXX(encoding=3, desc="RATING", text=str(rating)))
+        tags.save(full_path)
+    except Exception:
+        pass  # DB rating is authoritative; a read-only file shouldn't 500
+
+    # The tag write can grow the file when its padding runs out, which
+    # invalidates the size serve_mp3 caches and shifts every byte offset.
+    # Re-stat here: the inotify rescan won't catch it, because an in-place
+    # rewrite doesn't change the directory mtime and the channel is skipped.
+    try:
+        st = os.stat(full_path)
+        db.execute("UPDATE tracks SET mtime = ?, size = ? WHERE path = ?",
+                   (st.st_mtime, st.st_size, rel_path))
+        t = _track_index.get(rel_path)
+        if t is not None:
+            t["size"] = st.st_size
+    except OSError:
+        pass
+
     db.commit()
     db.close()
 
 
-def pick_stream_track() -> dict | None:
-    """Pick a random track weighted by rating. Unrated tracks use category average."""
-    all_tracks = []
+class _AliasSampler:
+    """Walker's alias method: O(n) to build, O(1) per weighted draw."""
+
+    def __init__(self, weights: list[float]):
+        n = len(weights)
+        total = sum(weights)
+        self.n = n
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+
+        scaled = [w * n / total for w in weights]
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Leftovers (float round-off) keep prob 1.0 and alias themselves.
+
+    def pick(self) -> int:
+        i = random.randrange(self.n)
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+# Flattened stream-pick pool: tracks plus an alias sampler over their
+# weights, rebuilt lazily after a library refresh or rating change.
+_stream_pool: tuple[list[dict], _AliasSampler] | None = None
+
+# Per-channel [sum, count] of positive ratings. Rebuilt from scratch after a
+# library refresh, adjusted in place on rating changes, so pool rebuilds
+# never re-walk every track just to average the categories.
+_cat_stats: dict[str, list[int]] = {}
+
+
+# Bumped whenever the tracks payload could differ; doubles as its ETag.
+_library_version = 0
+
+
+def invalidate_stream_pool(reset_stats: bool = True):
+    global _stream_pool, _library_version
+    _stream_pool = None
+    _library_version += 1
+    if reset_stats:
+        _cat_stats.clear()
+        _channel_json.clear()
+
+
+# Serialized per-channel track lists, glued into the /api/tracks body.
+# A rating click drops just its channel's fragment; a library reload
+# drops them all. The assembled body is cached against its ETag.
+_channel_json: dict[str, bytes] = {}
+_tracks_body: bytes = b""
+_tracks_gzip: bytes = b""
+_tracks_body_etag: str = ""
+
+
+def tracks_payload(gzip_ok: bool = False) -> tuple[bytes, str]:
+    """Return the encoded /api/tracks body and its ETag, re-serializing
+    only the channels whose fragment was invalidated."""
+    global _tracks_body, _tracks_gzip, _tracks_body_etag
+    etag = f'"{_library_version}"'
+    if _tracks_body_etag != etag:
+        parts = []
+        for channel, tracks in library.items():
+            frag = _channel_json.get(channel)
+            if frag is None:
+                # category just repeats the channel key and size is only
+                # used server-side — keep both off the wire.
+                frag = _channel_json[channel] = orjson.dumps(
+                    [{"artist": t["artist"], "title": t["title"], "rating": t["rating"], "path": t["path"]}
+                     for t in tracks]
+                )
+            parts.append(orjson.dumps(channel) + b":" + frag)
+        _tracks_body = b"{" + b",".join(parts) + b"}"
+        # JSON full of repeated keys compresses ~8x; pay for it once per
+        # library version, not per request.
+        _tracks_gzip = gzip.compress(_tracks_body, 6)
+        _tracks_body_etag = etag
+    return (_tracks_gzip if gzip_ok else _tracks_body), etag
+
+
+def update_cat_stats(category: str, old_rating: int, new_rating: int):
+    """Adjust a channel's running rating sum/count for one changed track."""
+    stats = _cat_stats.get(category)
+    if stats is None:
+        return  # not built yet; next pool rebuild computes it fresh
+    if old_rating > 0:
+        stats[0] -= old_rating
+        stats[1] -= 1
+    if new_rating > 0:
+        stats[0] += new_rating
+        stats[1] += 1
+
+
+def _build_stream_pool() -> tuple[list[dict], _AliasSampler]:
+    if not _cat_stats:
+        for channel, tracks in library.items():
+            total = count = 0
+            for t in tracks:
+                if t["rating"] > 0:
+                    total += t["rating"]
+                    count += 1
+            _cat_stats[channel] = [total, count]
+
+    all_tracks: list[dict] = []
+    weights: list[float] = []
     for channel, tracks in library.items():
-        rated = [t["rating"] for t in tracks if t["rating"] > 0]
-        cat_avg = sum(rated) / len(rated) if rated else 2.5
+        total, count = _cat_stats.get(channel, (0, 0))
+        cat_avg = total / count if count else 2.5
         for t in tracks:
-            weight = t["rating"] if t["rating"] > 0 else cat_avg
-            all_tracks.append((t, channel, weight))
-    if not all_tracks:
+            all_tracks.append(t)
+            weights.append(t["rating"] if t["rating"] > 0 else cat_avg)
+    return all_tracks, _AliasSampler(weights)
+
+
+def pick_stream_track() -> dict | None:
+    """Pick a random track weighted by rating. Unrated tracks use category average."""
+    global _stream_pool
+    if _stream_pool is None:
+        _stream_pool = _build_stream_pool()
+    tracks, sampler = _stream_pool
+    if not tracks:
         return None
-    tracks, channels, weights = zip(*all_tracks)
-    choice_idx = random.choices(range(len(all_tracks)), weights=weights, k=1)[0]
-    t = tracks[choice_idx]
-    return {**t, "category": channels[choice_idx]}
+    return tracks[sampler.pick()]
 
 
 def generate_html() -> str:
-    return """<!DOCTYPE html>
+    # Header/nav data baked into the page so first paint doesn't wait on
+    # the /api/tracks fetch and parse.
+    init = {
+        "total": sum(len(tracks) for tracks in library.values()),
+        "channels": [{"name": channel, "count": len(tracks)} for channel, tracks in library.items()],
+    }
+    page = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -305,6 +560,7 @@ def generate_html() -> str:
         <div class="stars" id="p-stars"></div>
     </div>
 
+    <script>window.__INIT__ = __INIT_JSON__;</script>
     <script>
     let channels = {};
     let currentChannel = null;
@@ -312,6 +568,25 @@ def generate_html() -> str:
     let tracks = [];
     let streaming = false;
 
+    function renderHeader(total, entries) {
+        document.getElementById('subtitle').textContent = total + ' tracks in ' + entries.length + ' channels';
+        const nav = document.getElementById('channels');
+        nav.innerHTML = '';
+        entries.forEach(({name, count}) => {
+            const a = document.createElement('a');
+            a.href = '#';
+            a.textContent = name + ' (' + count + ')';
+            a.onclick = e => { e.preventDefault(); stopStream(); showChannel(name); };
+            nav.appendChild(a);
+        });
+    }
+
+    // Subtitle and channel nav render immediately from the server-embedded
+    // counts; the full track listing fills in when the fetch lands.
+    if (window.__INIT__ && window.__INIT__.channels.length) {
+        renderHeader(window.__INIT__.total, window.__INIT__.channels);
+    }
+
     async function init() {
         const resp = await fetch('/api/tracks');
         channels = await resp.json();
@@ -321,17 +596,7 @@ def generate_html() -> str:
             return;
         }
         const total = names.reduce((s, k) => s + channels[k].length, 0);
-        document.getElementById('subtitle').textContent = total + ' tracks in ' + names.length + ' channels';
-
-        const nav = document.getElementById('channels');
-        names.forEach(name => {
-            const a = document.createElement('a');
-            a.href = '#';
-            a.textContent = name + ' (' + channels[name].length + ')';
-            a.onclick = e => { e.preventDefault(); stopStream(); showChannel(name); };
-            nav.appendChild(a);
-        });
-
+        renderHeader(total, names.map(name => ({name: name, count: channels[name].length})));
         showChannel(names[0]);
     }
 
@@ -346,36 +611,44 @@ def generate_html() -> str:
 
     function renderTable() {
         const tbody = document.querySelector('#tracklist tbody');
-        tbody.innerHTML = '';
         const showCat = currentChannel === null;
-        const head = document.createElement('tr');
-        head.innerHTML = '<th class="num">#</th><th>Artist</th><th>Title</th>' +
-            (showCat ? '<th>Category</th>' : '') + '<th>Rating</th>';
-        tbody.appendChild(head);
+        // Build the whole table as one string and assign innerHTML once:
+        // a single parse/reflow instead of one per row. Row clicks are
+        // handled by the delegated listener on tbody.
+        const parts = ['<tr><th class="num">#</th><th>Artist</th><th>Title</th>' +
+            (showCat ? '<th>Category</th>' : '') + '<th>Rating</th></tr>'];
         tracks.forEach((t, i) => {
-            const tr = document.createElement('tr');
-            tr.dataset.idx = i;
-            tr.onclick = () => play(i);
-            if (i === currentIdx) tr.classList.add('playing');
-            tr.innerHTML = '<td class="num">' + (i + 1) + '</td>' +
+            parts.push('<tr data-idx="' + i + '"' + (i === currentIdx ? ' class="playing"' : '') + '>' +
+                '<td class="num">' + (i + 1) + '</td>' +
                 '<td>' + esc(t.artist) + '</td>' +
                 '<td>' + esc(t.title) + '</td>' +
                 (showCat ? '<td class="cat">' + esc(t.category || '') + '</td>' : '') +
-                '<td>' + starsHtml(t.rating, i) + '</td>';
-            tbody.appendChild(tr);
+                '<td>' + starsHtml(t.rating, i) + '</td></tr>');
         });
+        tbody.innerHTML = parts.join('');
     }
 
-    function starsHtml(rating, idx) {
-        let h = '<span class="stars" data-idx="' + idx + '">';
+    document.querySelector('#tracklist tbody').addEventListener('click', e => {
+        const tr = e.target.closest('tr[data-idx]');
+        if (tr) play(+tr.dataset.idx);
+    });
+
+    // Six possible star rows (ratings 0-5), built once. The handlers find
+    // their track via the enclosing .stars element's data-idx.
+    const STAR_CACHE = [];
+    for (let r = 0; r <= 5; r++) {
+        let h = '';
         for (let i = 1; i <= 5; i++) {
-            h += '<span data-v="' + i + '" class="' + (i <= rating ? 'on' : '') + '"' +
-                ' onclick="event.stopPropagation(); rate(' + idx + ',' + i + ')"' +
+            h += '<span data-v="' + i + '" class="' + (i <= r ? 'on' : '') + '"' +
+                ' onclick="event.stopPropagation(); rate(+this.parentElement.dataset.idx, +this.dataset.v)"' +
                 ' onmouseenter="previewStars(this)" onmouseleave="clearPreview(this)"' +
                 '>&#9733;</span>';
         }
-        h += '</span>';
-        return h;
+        STAR_CACHE.push(h);
+    }
+
+    function starsHtml(rating, idx) {
+        return '<span class="stars" data-idx="' + idx + '">' + STAR_CACHE[rating] + '</span>';
     }
 
     function previewStars(el) {
@@ -479,41 +752,194 @@ def generate_html() -> str:
     </script>
 </body>
 </html>"""
+    return page.replace("__INIT_JSON__", orjson.dumps(init).decode())
+
+
+# Rendered page cached against the library version: the markup only
+# changes when the embedded channel counts do.
+_html_bytes: bytes = b""
+_html_gzip: bytes = b""
+_html_etag: str = ""
+
+
+def html_payload(gzip_ok: bool = False) -> bytes:
+    global _html_bytes, _html_gzip, _html_etag
+    etag = f'"{_library_version}"'
+    if _html_etag != etag:
+        _html_bytes = generate_html().encode()
+        _html_gzip = gzip.compress(_html_bytes, 6)
+        _html_etag = etag
+    return _html_gzip if gzip_ok else _html_bytes
+
+
+def watch_library(debounce: float = 2.0):
+    """Rescan only when the kernel reports library changes, via inotify.
+
+    Runs as a daemon thread. The scraper publishes tracks with a rename into
+    the channel dir, so IN_MOVED_TO fires exactly once per finished track.
+    On platforms without inotify this returns and /api/tracks?rescan=1
+    remains the manual fallback.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        inotify_fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return
+    if inotify_fd < 0:
+        return
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def add_watches():
+        # Watching a path twice just updates the existing watch, so re-adding
+        # after each rescan cheaply picks up new channel dirs.
+        libc.inotify_add_watch(inotify_fd, os.fsencode(MP3_ROOT), mask)
+        with os.scandir(MP3_ROOT) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    libc.inotify_add_watch(inotify_fd, os.fsencode(entry.path), mask)
+
+    if not MP3_DIR.is_dir():
+        return
+    add_watches()
+
+    while True:
+        os.read(inotify_fd, 65536)  # block until something changes
+        time.sleep(debounce)  # let the burst around a new track settle
+        os.set_blocking(inotify_fd, False)
+        try:
+            while os.read(inotify_fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        os.set_blocking(inotify_fd, True)
+        refresh_library_cache(force_scan=True)
+        add_watches()
+
+
+def parse_range(range_header: str, file_size: int) -> tuple[int, int] | None:
+    """Parse a bytes=start-end Range header in one pass; None if unusable.
+
+    Handles the forms browsers actually send: start-, start-end, and the
+    -suffix form for the last N bytes. Malformed headers get a full 200
+    response instead of a stack trace.
+    """
+    if not range_header.startswith("bytes="):
+        return None
+    start_s, sep, end_s = range_header[6:].partition("-")
+    if not sep:
+        return None
+    try:
+        if start_s:
+            start = int(start_s)
+            end = int(end_s) if end_s else file_size - 1
+        elif end_s:
+            start = max(0, file_size - int(end_s))
+            end = file_size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    end = min(end, file_size - 1)
+    if start < 0 or start > end:
+        return None
+    return start, end
+
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer variant that handles connections on a bounded
+    worker pool instead of spawning one thread per connection."""
+
+    pool_size = 16
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
 
 
 class MusicHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open, so the page, the tracks JSON, and
+    # the audio Range requests all reuse one TCP connection.
+    protocol_version = "HTTP/1.1"
+
+    # Each keep-alive connection holds a pool worker while it waits for the
+    # next request; without a timeout, 16 idle browser tabs would pin every
+    # worker and wedge the server. handle_one_request treats the timeout as
+    # close-connection, freeing the worker.
+    timeout = 60
+
+    def setup(self):
+        super().setup()
+        # Small responses (JSON, headers) go out immediately instead of
+        # waiting on Nagle; MP3 bodies get explicit TCP_CORK batching.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     def log_message(self, fmt, *args):
         pass
 
-    def send_json(self, data, status=200):
-        body = json.dumps(data).encode()
+    def send_json(self, data, status=200, etag=None):
+        body = orjson.dumps(data)
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        if etag:
+            self.send_header("ETag", etag)
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
         self.wfile.write(body)
 
     def do_GET(self):
+        global library
         parsed = urllib.parse.urlparse(self.path)
         path = parsed.path
 
         if path == "/":
-            html = generate_html().encode()
+            if not library:
+                refresh_library_cache(force_scan=False)
+            accepts_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+            html = html_payload(gzip_ok=accepts_gzip)
             self.send_response(200)
             self.send_header("Content-Type", "text/html; charset=utf-8")
+            if accepts_gzip:
+                self.send_header("Content-Encoding", "gzip")
             self.send_header("Content-Length", str(len(html)))
             self.end_headers()
             self.wfile.write(html)
 
         elif path == "/api/tracks":
-            global library
             query = urllib.parse.parse_qs(parsed.query)
             force_scan = query.get("rescan", ["0"])[0].lower() in {"1", "true", "yes"}
             if force_scan:
                 refresh_library_cache(force_scan=True)
             elif not library:
                 refresh_library_cache(force_scan=False)
-            self.send_json(library)
+
+            accepts_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+            body, etag = tracks_payload(gzip_ok=accepts_gzip)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("ETag", etag)
+            if accepts_gzip:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
         elif path == "/api/stream":
             track = pick_stream_track()
@@ -537,7 +963,21 @@ class MusicHandler(BaseHTTPRequestHandler):
         if self.path == "/api/rate":
             try:
                 length = int(self.headers.get("Content-Length", 0))
-                body = json.loads(self.rfile.read(length))
+                if not 0 < length <= 4096:
+                    self.send_json({"error": "bad content length"}, 400)
+                    return
+                # One preallocated buffer instead of rfile.read's fresh
+                # bytes; orjson parses straight from the memoryview.
+                buf = bytearray(length)
+                view = memoryview(buf)
+                read = 0
+                while read < length:
+                    n = self.rfile.readinto(view[read:])
+                    if not n:
+                        self.send_json({"error": "truncated body"}, 400)
+                        return
+                    read += n
+                body = orjson.loads(view)
                 rel_path = body["path"]
                 rating = int(body["rating"])
 
@@ -545,41 +985,53 @@ class MusicHandler(BaseHTTPRequestHandler):
                     self.send_json({"error": "rating must be 0-5"}, 400)
                     return
 
-                full_path = (MP3_DIR / rel_path).resolve()
-                if not str(full_path).startswith(str(MP3_DIR.resolve())) or not full_path.is_file():
+                full_path = safe_full_path(rel_path)
+                if full_path is None or not full_path.is_file():
                     self.send_json({"error": "invalid path"}, 400)
                     return
 
                 set_rating(rel_path, rating)
 
                 # Update in-memory cache
-                for channel_tracks in library.values():
-                    for t in channel_tracks:
-                        if t["path"] == rel_path:
-                            t["rating"] = rating
-                            break
+                t = _track_index.get(rel_path)
+                if t is not None:
+                    update_cat_stats(t["category"], t["rating"], rating)
+                    t["rating"] = rating
+                    _channel_json.pop(t["category"], None)
 
+                invalidate_stream_pool(reset_stats=False)
                 self.send_json({"ok": True})
             except Exception as e:
                 self.send_json({"error": str(e)}, 500)
         else:
             self.send_error(404)
 
+    # Kernel send buffer for MP3 streaming: big enough that sendfile can
+    # hand the kernel a whole track's worth of queued data on a fast LAN.
+    MP3_SNDBUF = 2 * 1024 * 1024
+
     def serve_mp3(self, rel_path: str):
-        full_path = (MP3_DIR / rel_path).resolve()
-        if not str(full_path).startswith(str(MP3_DIR.resolve())) or not full_path.is_file():
+        full_path = safe_full_path(rel_path)
+        if full_path is None or not full_path.is_file():
             self.send_error(404)
             return
 
-        file_size = full_path.stat().st_size
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.MP3_SNDBUF)
+        # Cork the socket across headers + first body bytes so they leave
+        # in one packet; uncorking below flushes whatever remains.
+        cork = hasattr(socket, "TCP_CORK")
+        if cork:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+        # The scan already recorded the size; only stat for files the
+        # library hasn't picked up yet.
+        track = _track_index.get(rel_path)
+        file_size = track["size"] if track and track.get("size") else full_path.stat().st_size
         range_header = self.headers.get("Range")
 
-        if range_header:
-            range_spec = range_header.replace("bytes=", "")
-            parts = range_spec.split("-")
-            start = int(parts[0]) if parts[0] else 0
-            end = int(parts[1]) if parts[1] else file_size - 1
-            end = min(end, file_size - 1)
+        byte_range = parse_range(range_header, file_size) if range_header else None
+        if byte_range:
+            start, end = byte_range
             length = end - start + 1
 
             self.send_response(206)
@@ -595,18 +1047,20 @@ class MusicHandler(BaseHTTPRequestHandler):
         self.send_header("Accept-Ranges", "bytes")
         self.end_headers()
 
-        with open(full_path, "rb") as f:
-            f.seek(start)
-            remaining = length
-            while remaining > 0:
-                chunk = f.read(min(65536, remaining))
-                if not chunk:
-                    break
+        # wfile is unbuffered, so the headers are already on the wire and the
+        # body can go kernel-to-kernel without touching userspace.
+        try:
+            with open(full_path, "rb") as f:
+                try:
+                    self.connection.sendfile(f, start, length)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+        finally:
+            if cork:
                 try:
-                    self.wfile.write(chunk)
-                except BrokenPipeError:
-                    break
-                remaining -= len(chunk)
+                    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+                except OSError:
+                    pass  # client already gone
 
 
 def main():
@@ -619,7 +1073,9 @@ def main():
     else:
         print(f"Scanned library at {MP3_DIR}: {total} tracks in {len(library)} channels")
 
-    server = ThreadingHTTPServer((HOST, PORT), MusicHandler)
+    threading.Thread(target=watch_library, daemon=True).start()
+
+    server = PooledHTTPServer((HOST, PORT), MusicHandler)
     print(f"Serving at http://{HOST}:{PORT}")
     try:
         server.serve_forever()